@@ -1,12 +1,123 @@
+import codecs
 import json
 import os
+import re
+import sys
+import threading
+import zlib
 from abc import ABC, abstractmethod
-from typing import Dict, Optional, Any
+from contextlib import contextmanager
+from types import MappingProxyType
+from typing import Dict, Optional, Any, Tuple, IO, Mapping, Iterator, Set
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore[assignment]
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore[assignment]
 
 __version__ = '1.0'
 __author__ = 'Riccardo De Zen'
 __email__ = 'riccardodezen98@gmail.com'
 
+# `fdatasync` is not available on every platform.
+_datasync = getattr(os, 'fdatasync', os.fsync)
+
+# Whitespace allowed between JSON tokens.
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _skip_whitespace(text: str, pos: int = 0) -> int:
+    """
+    :param text: The text to scan.
+    :param pos: Where to start from.
+    :return: Position of the first character after `pos` that is not whitespace.
+    """
+    match = _WHITESPACE.match(text, pos)
+    return match.end() if match is not None else pos
+
+
+def _orjson_option(kwargs: Dict[str, Any]) -> Optional[int]:
+    """
+    Translate arguments meant for `json.dumps` into `orjson` options.
+
+    :param kwargs: Arguments for `json.dumps`.
+    :return: The `orjson` options, `None` if `orjson` is not available or cannot honour the arguments.
+    """
+    if orjson is None:
+        return None
+
+    # `json` turns non string keys into strings.
+    option = orjson.OPT_NON_STR_KEYS
+    for name, value in kwargs.items():
+        if name == 'indent' and value in (None, 2):
+            option |= orjson.OPT_INDENT_2 if value else 0
+        elif name == 'sort_keys':
+            option |= orjson.OPT_SORT_KEYS if value else 0
+        else:
+            return None
+    return option
+
+
+def _intern(data: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Intern the keys of the data, so that they are shared with equal keys used elsewhere, for instance to look items up.
+    Keys of the items are left alone, `json` already shares keys repeated across items of the same file.
+
+    :param data: The data as loaded from a file.
+    :return: The same data, with interned keys.
+    """
+    return dict(zip(map(sys.intern, data), data.values()))
+
+
+def _write_all(fd: int, data: bytes, offset: Optional[int] = None) -> None:
+    """
+    Write the whole data, a single write may only write part of it.
+
+    :param fd: The file descriptor to write to.
+    :param data: The data to write.
+    :param offset: Where to write the data, `None` to write at the position of the file.
+    :raises IOError: If the data could not be written.
+    """
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view) if offset is None else os.pwrite(fd, view, offset)
+        if written == 0:
+            raise IOError("Could not write the whole data.")
+        view = view[written:]
+        if offset is not None:
+            offset += written
+
+
+def _log_checksum(header: bytes) -> Optional[int]:
+    """
+    :param header: First line of a write-ahead log.
+    :return: Checksum of the file the log applies to, `None` if the line is not a valid header.
+    """
+    try:
+        return json.loads(header)['crc']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _json_encoder(kwargs: Dict[str, Any]) -> json.JSONEncoder:
+    """
+    :param kwargs: Arguments for `json.dumps`.
+    :return: An encoder behaving like `json.dumps` with the given arguments.
+    """
+    kwargs = dict(kwargs)
+    cls = kwargs.pop('cls', None) or json.JSONEncoder
+    return cls(**kwargs)
+
 
 class Storage(ABC):
     """
@@ -14,21 +125,23 @@ class Storage(ABC):
     Subclasses may decide to implement some ways to cache the data and/or access single values.
     """
 
+    __slots__ = ()
+
     @abstractmethod
-    def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
+    def read(self) -> Optional[Mapping[str, Dict[str, Any]]]:
         """
         Read the data in the storage.
 
-        :return: The data in the storage. Should return `None` if no data is found.
+        :return: The data in the storage, which may be a read-only mapping. Should return `None` if no data is found.
         """
         raise NotImplementedError(f"{self.__class__} is abstract.")
 
     @abstractmethod
-    def write(self, data: Dict[str, Dict[str, Any]]) -> None:
+    def write(self, data: Mapping[str, Dict[str, Any]]) -> None:
         """
         Write the given data in the storage.
 
-        :param data: Any Dictionary.
+        :param data: Any Dictionary, or a read-only mapping such as the one returned by `read`.
         """
         raise NotImplementedError(f"{self.__class__} is abstract.")
 
@@ -59,16 +172,116 @@ class Storage(ABC):
         pass
 
 
+class _Index:
+    """
+    Location of the top-level items of a JSON object inside a file, used to update single items without rewriting the
+    whole file.
+    """
+
+    __slots__ = ('slots', 'end', 'size', 'garbage')
+
+    def __init__(self, slots: Dict[str, Tuple[int, int]], end: int, size: int, garbage: int):
+        """
+        :param slots: Offset and length in bytes of the value of each key, trailing whitespace included.
+        :param end: Offset of the closing brace of the object.
+        :param size: Size of the file in bytes.
+        :param garbage: Bytes taken up by values that have been superseded by a later occurrence of the same key.
+        """
+        self.slots = slots
+        self.end = end
+        self.size = size
+        self.garbage = garbage
+
+    @staticmethod
+    def scan(raw: bytes, encoding: str) -> Optional['_Index']:
+        """
+        Locate the items of the JSON object contained in `raw`.
+
+        :param raw: Content of the file.
+        :param encoding: Encoding of the file, used to decode keys.
+        :return: The index, `None` if `raw` does not contain a JSON object.
+        """
+        # One character per byte, so that offsets in the text are offsets in the file.
+        text = raw.decode('latin-1')
+        decoder = json.JSONDecoder()
+        slots: Dict[str, Tuple[int, int]] = dict()
+        garbage = 0
+
+        try:
+            pos = _skip_whitespace(text)
+            if not text.startswith('{', pos):
+                return None
+            pos = _skip_whitespace(text, pos + 1)
+            if text.startswith('}', pos):
+                return _Index(slots, pos, len(raw), garbage)
+
+            while True:
+                # Key and colon.
+                _, key_end = decoder.raw_decode(text, pos)
+                key = json.loads(raw[pos:key_end].decode(encoding))
+                pos = _skip_whitespace(text, key_end)
+                if not text.startswith(':', pos):
+                    return None
+
+                # Value and the whitespace after it.
+                start = _skip_whitespace(text, pos + 1)
+                _, value_end = decoder.raw_decode(text, start)
+                pos = _skip_whitespace(text, value_end)
+
+                # When a key is repeated the last value is the one that counts.
+                if key in slots:
+                    garbage += slots[key][1]
+                slots[key] = (start, pos - start)
+
+                if text.startswith('}', pos):
+                    return _Index(slots, pos, len(raw), garbage)
+                if not text.startswith(',', pos):
+                    return None
+                pos = _skip_whitespace(text, pos + 1)
+        except ValueError:
+            return None
+
+
 class JSONStorage(Storage):
     """
-    Naive storage interface, uses `json` module to serialize. This implies data must be of the types accepted by the
-    JSON format.
+    Naive storage interface, uses `json` module to serialize, or optionally `orjson`. This implies data must be of the
+    types accepted by the JSON format.
+
+    Single items are updated without rewriting the whole file: a value that fits in the space of the old one overwrites
+    it and is padded with whitespace, a bigger one is appended at the end of the object and the old one is left behind
+    (when a key is repeated `json` keeps the last value). The whole file is rewritten once the values left behind take
+    up more than half of it. Formatting arguments such as `indent` only lay out the whole file when it is rewritten,
+    appended items are indented on their own. Items are never updated in place with `sort_keys`, to keep the order.
+
+    With a write-ahead log, single items are instead appended to a log next to the file, which is merged back into the
+    file when closing the storage or when it grows beyond `WAL_LIMIT` bytes. The log starts with a checksum of the file
+    it applies to, and is ignored on top of any other file, for instance if a crash happened after the file was merged
+    but before the log was emptied.
+
+    The data is cached after the first read. Call `reload` if the file is modified by other sources. Reads and writes
+    lock the file where `fcntl` is available, so that other processes reading it never see a write in progress.
     """
 
-    def __init__(self, path: str, mode='r+', **kwargs):
+    __slots__ = (
+        '_mode', '_kwargs', '_can_write', '_file', '_raw', '_encoding', '_option', '_encoder', '_line_encoder',
+        '_can_patch', '_index', '_last_size', '_wal', '_wal_size', '_checksum', '_cache', '_group_commit', '_pending',
+        '_timer', '_lock', '_error'
+    )
+
+    # Size in bytes of the write-ahead log past which it is merged into the file.
+    WAL_LIMIT = 4 * 1024 * 1024
+
+    def __init__(self, path: str, mode='r+', group_commit_ms: float = 0.0, wal: bool = False, use_orjson: bool = False,
+                 **kwargs):
         """
         :param path: The path to the file.
         :param mode: The mode with which to access the file.
+        :param group_commit_ms: If positive, syncing to disk is delayed by up to this many milliseconds so that the
+            writes happening in the meantime share a single sync. Call `commit` to sync immediately.
+        :param wal: Whether to keep a write-ahead log of single items in `path + '.wal'`.
+        :param use_orjson: Whether to serialize with `orjson` when it is installed, the file is UTF-8 and `kwargs` are
+            only `indent=2` and `sort_keys`. Beware `orjson` writes `NaN` and infinities as `null`. Falls back to `json`
+            for data `orjson` cannot handle, such as integers beyond 64 bits.
         :param kwargs: Any arguments that you wish to pass to `json.dumps`.
         """
         # Store params.
@@ -76,69 +289,446 @@ class JSONStorage(Storage):
         self._kwargs = kwargs
 
         # Prepare file.
-        self._can_write = any([c in mode for c in ('a', 'w', '+')])
+        self._can_write = not {'a', 'w', '+'}.isdisjoint(mode)
         self._file = open(path, mode)
 
-    def close(self):
-        self._file.close()
+        # The file is always read from start to end.
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self._file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        # Binary file underneath and its encoding, the file may already be binary.
+        self._raw = getattr(self._file, 'buffer', self._file)
+        self._encoding = getattr(self._file, 'encoding', None) or 'utf-8'
+
+        # `orjson` only deals with UTF-8.
+        utf8 = codecs.lookup(self._encoding).name == 'utf-8'
+        self._option = _orjson_option(kwargs) if use_orjson and utf8 else None
+
+        # Reuse the same `json` encoders for every write.
+        self._encoder = _json_encoder(kwargs)
+        self._line_encoder = _json_encoder({**kwargs, 'indent': None}) if kwargs.get('indent') else self._encoder
+
+        # Updating single items needs to read the file, and positional writes ignore the offset in append mode. With
+        # `sort_keys` new items would be appended after the last key, and the file would no longer be sorted. With a
+        # write-ahead log items go to the log instead.
+        self._can_patch = (
+            self._can_write and not {'r', '+'}.isdisjoint(mode) and 'a' not in mode and not kwargs.get('sort_keys')
+            and not wal
+        )
+        self._index: Optional[_Index] = None
+
+        # Size of the file, tracked to only truncate it when it gets shorter.
+        self._last_size = os.fstat(self._file.fileno()).st_size
+
+        # Write-ahead log, if any, and checksum of the file it applies to. Only opened for reading if it exists and the
+        # file cannot be written.
+        self._wal: Optional[IO[bytes]] = None
+        self._checksum: Optional[int] = None
+        if wal and self._can_write:
+            self._wal = open(path + '.wal', 'a+b')
+            self._recover_log()
+        elif wal and os.path.exists(path + '.wal'):
+            self._wal = open(path + '.wal', 'rb')
+        self._wal_size = os.fstat(self._wal.fileno()).st_size if self._wal is not None else 0
+
+        # Data in the file, loaded on the first read.
+        self._cache: Optional[Dict[str, Dict[str, Any]]] = None
+
+        # Files waiting to be synced, the timer that will sync them, and the error it got if syncing failed.
+        self._group_commit = group_commit_ms / 1000
+        self._pending: Set[IO] = set()
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._error: Optional[Exception] = None
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+
+        try:
+            # Merge the log into the file.
+            if self._wal is not None and self._wal_size > 0 and self._can_write:
+                self.write(self.read() or dict())
+
+            self.commit()
+
+            # Sync any metadata left behind.
+            if self._can_write:
+                os.fsync(self._file.fileno())
+        finally:
+            if self._wal is not None:
+                self._wal.close()
+            self._file.close()
+
+    def commit(self) -> None:
+        """
+        Sync pending writes to disk.
+
+        :raises OSError: If syncing failed, now or when the sync was scheduled to happen.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            error, self._error = self._error, None
+            try:
+                for file in self._pending:
+                    self._fsync(file)
+            finally:
+                self._pending.clear()
+
+        if error is not None:
+            raise error
+
+    def _commit_later(self) -> None:
+        """
+        Sync pending writes from the timer. Errors would be lost with the timer's thread, they are kept for the next
+        `commit` instead.
+        """
+        try:
+            self.commit()
+        except Exception as e:
+            self._error = e
 
     def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
-        self._file.seek(0, os.SEEK_END)
-        size = self._file.tell()
+        """
+        :return: The cached data itself, not a copy. Change it only through `write` or `__setitem__`, other changes are
+            seen by this storage but never written to the file.
+        """
+        if self._cache is None:
+            self._cache = self._load()
 
-        # Empty file, return None
-        if size == 0:
-            return None
+            # Data is cached, the kernel does not need to keep the file around. Read-only storages leave it, other
+            # processes reading the file may still need it, and so do storages that read it again to update items.
+            if self._can_write and not self._can_patch and hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(self._file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return self._cache
 
-        self._file.seek(0)
-        return json.load(self._file)
+    def reload(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        Drop the cached data and read the file again.
+
+        :return: The data in the storage.
+        """
+        self._cache = None
+        self._index = None
+        self._checksum = None
+        self._last_size = os.fstat(self._file.fileno()).st_size
+        return self.read()
 
-    def write(self, data: Dict[str, Dict[str, Any]]) -> None:
+    def _load(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        :return: The data in the file, `None` if the file is empty.
+        """
+        data = None
+        raw = b''
+        with self._locked(exclusive=False):
+            if os.fstat(self._file.fileno()).st_size > 0:
+                self._file.seek(0)
+                raw = self._raw.read()
+                data = self._loads(raw)
+
+            # Replay the log on top of the file, if it was logged against this file.
+            if self._wal is not None:
+                self._checksum = zlib.crc32(raw)
+                self._wal.seek(0)
+                header = self._wal.readline()
+                for line in self._wal if _log_checksum(header) == self._checksum else ():
+                    try:
+                        record = json.loads(line.decode(self._encoding))
+                    except ValueError:
+                        # Record not fully written, possibly still being written by another process.
+                        continue
+                    data = data if data is not None else dict()
+                    data[record['k']] = record['v']
+
+        return _intern(data) if isinstance(data, dict) else data
+
+    def write(self, data: Mapping[str, Dict[str, Any]]) -> None:
         # If the database cannot write raises an Exception.
         if not self._can_write:
             raise IOError(f"Cannot write, access mode is \'{self._mode}\'.")
 
-        self._file.seek(0)
-        self._file.write(json.dumps(data, **self._kwargs))
+        # Copy the data, so that read-only mappings can be serialized and later changes to the caller's dictionary are
+        # not seen by the cache.
+        data = dict(data)
 
-        # Ensure the file has been written
-        self._file.flush()
-        os.fsync(self._file.fileno())
+        with self._locked(exclusive=True):
+            self._dump(data)
+
+            # The file must be on disk before the log is dropped, and the log must be dropped before it can be replayed
+            # over the file again. Readers must not see the new file with the old log.
+            if self._wal is not None:
+                self._fsync(self._file)
+                self._wal.truncate(0)
+                self._fsync(self._wal)
+                self._wal_size = 0
+
+        if self._wal is None:
+            self._sync(self._file)
 
-        # Truncate if file got shorter
-        self._file.truncate()
+        # Items have moved.
+        self._index = None
+        self._cache = data
 
     def __getitem__(self, key: str) -> Optional[Dict[str, Any]]:
-        # Return an item after reading the file.
-        data = self.read()
+        # Return an item after reading the file, only the first time.
+        data = self._cache if self._cache is not None else self.read()
         return data[key] if data else None
 
     def __setitem__(self, key: str, value: Dict[str, Any]):
-        # Reads the whole file and rewrites everything.
-        data = self.read()
+        key = sys.intern(key) if type(key) is str else key
+
+        if self._wal is not None:
+            self._log(key, value)
+            return
+
+        # Try to only write the item.
+        if self._can_patch and isinstance(key, str):
+            if self._index is None:
+                with self._locked(exclusive=False):
+                    raw = self._read_file()
+                self._index = _Index.scan(raw, self._encoding)
+            if self._index is not None and self._patch(key, value):
+                if self._cache is not None:
+                    self._cache[key] = value
+                return
+
+        # Rewrites everything, the cache is only updated if writing succeeds.
+        data = dict(self.read() or dict())
         data[key] = value
         self.write(data)
 
+    def _dump(self, data: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Overwrite the file with the given data. The data is serialized in one piece before touching the file, so that
+        the file is left as it was if serializing fails. Streaming into the file would leave it half written, and
+        streaming into another file that then replaces it would leave other processes reading and locking the old one.
+
+        :param data: The data to write.
+        """
+        payload = self._dumps(data)
+
+        # Already in one piece, skip the file buffer.
+        fd = self._file.fileno()
+        if 'a' in self._mode:
+            # Writes always go at the end in append mode, empty the file first.
+            os.ftruncate(fd, 0)
+            _write_all(fd, payload)
+        else:
+            _write_all(fd, payload, 0)
+
+            # Truncate if file got shorter, a single sync then covers both the content and the size.
+            if len(payload) < self._last_size:
+                os.ftruncate(fd, len(payload))
+        self._last_size = len(payload)
+
+        # A new log applies to this content.
+        if self._wal is not None:
+            self._checksum = zlib.crc32(payload)
+
+    def _dumps(self, obj: Any, line: bool = False) -> bytes:
+        """
+        :param obj: The object to serialize.
+        :param line: Whether to ignore indentation and serialize the object on a single line.
+        :return: The object serialized in the encoding of the file.
+        """
+        if self._option is not None:
+            option = self._option & ~orjson.OPT_INDENT_2 if line else self._option
+            try:
+                return orjson.dumps(obj, option=option)
+            except orjson.JSONEncodeError:
+                # Let `json` try, for instance with integers beyond 64 bits.
+                pass
+        encoder = self._line_encoder if line else self._encoder
+        return encoder.encode(obj).encode(self._encoding)
+
+    def _loads(self, raw: bytes) -> Any:
+        """
+        :param raw: Serialized data in the encoding of the file.
+        :return: The data.
+        """
+        if self._option is not None:
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError:
+                # Let `json` try, for instance with `NaN` or integers beyond 64 bits.
+                pass
+        return json.loads(raw.decode(self._encoding))
+
+    def _log(self, key: str, value: Dict[str, Any]) -> None:
+        """
+        Append a single item to the write-ahead log, merging the log into the file if it got too big.
+
+        :param key: Key of the item.
+        :param value: The new value for the item.
+        """
+        # If the database cannot write raises an Exception.
+        if not self._can_write:
+            raise IOError(f"Cannot write, access mode is \'{self._mode}\'.")
+
+        wal = self._wal
+        assert wal is not None
+        record = self._dumps({'k': key, 'v': value}, line=True) + b'\n'
+        fd = wal.fileno()
+        with self._locked(exclusive=True):
+            # Stamp a new log with the file it applies to.
+            if self._wal_size == 0:
+                if self._checksum is None:
+                    self._checksum = zlib.crc32(self._read_file())
+                record = json.dumps({'crc': self._checksum}).encode(self._encoding) + b'\n' + record
+
+            try:
+                _write_all(fd, record)
+            except OSError as e:
+                # Do not leave part of the record behind, the next one would be appended to it.
+                os.ftruncate(fd, self._wal_size)
+                raise e
+        self._wal_size += len(record)
+        self._sync(wal)
+
+        if self._cache is not None:
+            self._cache[key] = value
+
+        if self._wal_size > self.WAL_LIMIT:
+            self.write(self.read() or dict())
+
+    def _recover_log(self) -> None:
+        """
+        Drop a record left incomplete at the end of the log, for instance by a crash. The next record would otherwise
+        be appended to it and be lost as well. Drop the whole log if it does not apply to the file, the records after
+        it would otherwise be ignored too.
+        """
+        wal = self._wal
+        assert wal is not None
+        with self._locked(exclusive=True):
+            wal.seek(0)
+            raw = wal.read()
+            end = raw.rfind(b'\n') + 1
+            if end > 0 and _log_checksum(raw[:raw.find(b'\n')]) != zlib.crc32(self._read_file()):
+                end = 0
+            if end < len(raw):
+                wal.truncate(end)
+                self._fsync(wal)
+
+    def _read_file(self) -> bytes:
+        """
+        :return: The content of the file, read without moving the file's position.
+        """
+        fd = self._file.fileno()
+        return os.pread(fd, os.fstat(fd).st_size, 0)
+
+    def _patch(self, key: str, value: Dict[str, Any]) -> bool:
+        """
+        Write a single item in place or at the end of the object.
+
+        :param key: Key of the item.
+        :param value: The new value for the item.
+        :return: `False` if the file needs to be rewritten instead.
+        """
+        index = self._index
+        assert index is not None
+        encoded = self._dumps(value)
+        slot = index.slots.get(key)
+        fd = self._file.fileno()
+
+        if slot is not None and len(encoded) <= slot[1]:
+            # Overwrite the old value.
+            with self._locked(exclusive=True):
+                _write_all(fd, encoded.ljust(slot[1]), slot[0])
+        else:
+            # Too much garbage, compact the file.
+            garbage = index.garbage + (slot[1] if slot is not None else 0)
+            if garbage > index.size // 2:
+                return False
+
+            # Replace the closing brace with the new item.
+            separator = ', ' if index.slots else ''
+            head = f'{separator}{json.dumps(key)}: '.encode(self._encoding)
+            with self._locked(exclusive=True):
+                _write_all(fd, head + encoded + b'}', index.end)
+
+            index.slots[key] = (index.end + len(head), len(encoded))
+            index.end += len(head) + len(encoded)
+            index.size = max(index.size, index.end + 1)
+            self._last_size = max(self._last_size, index.size)
+            index.garbage = garbage
+
+        # Ensure the file has been written
+        self._sync(self._file)
+        return True
+
+    @contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        """
+        Hold a lock on the file, so that readers never see a write in progress. Does nothing where `fcntl` is not
+        available.
+
+        :param exclusive: Whether to lock for writing, otherwise readers can share the lock.
+        """
+        if fcntl is None:
+            yield
+            return
+
+        fd = self._file.fileno()
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _fsync(self, file: IO) -> None:
+        """
+        Sync the content of a file to disk. Metadata is only synced when needed to read the content back, a full sync is
+        left to `close`.
+
+        :param file: The file to sync.
+        """
+        _datasync(file.fileno())
+
+    def _sync(self, file: IO) -> None:
+        """
+        Sync a file to disk, or schedule the sync when using group commit.
+
+        :param file: The file to sync.
+        """
+        if self._group_commit <= 0:
+            self._fsync(file)
+            return
+
+        with self._lock:
+            self._pending.add(file)
+            if self._timer is None:
+                self._timer = threading.Timer(self._group_commit, self._commit_later)
+                self._timer.daemon = True
+                self._timer.start()
+
 
 class MemoryStorage(Storage):
     """
     Storage class keeping a dictionary in memory. Useful for testing.
     """
 
-    def __init__(self):
+    __slots__ = ('_data',)
+
+    def __init__(self) -> None:
         # Data in the storage.
-        self._data = None
+        self._data: Optional[Dict[str, Dict[str, Any]]] = None
 
     def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
         return self._data
 
-    def write(self, data: Dict[str, Dict[str, Any]]) -> None:
-        self._data = data
+    def write(self, data: Mapping[str, Dict[str, Any]]) -> None:
+        self._data = dict(data)
 
     def __getitem__(self, key: str) -> Dict[str, Any]:
+        if self._data is None:
+            raise KeyError(key)
         return self._data[key]
 
     def __setitem__(self, key: str, value: Dict[str, Any]):
+        if self._data is None:
+            self._data = dict()
         self._data[key] = value
 
 
@@ -148,49 +738,184 @@ class ItemStorage(Storage):
     updated. This class assumes the underlying storage is not modified by other external sources.
     """
 
+    __slots__ = ('_storage', '_data')
+
     def __init__(self, storage: Storage):
         """
         :param storage: The `Storage` to wrap.
         """
-        self._storage = storage
-        self._data = storage.read()
+        self._storage: Storage = storage
 
-    def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        # The cache is modified in place, copy read-only mappings.
+        data = storage.read()
+        self._data: Optional[Dict[str, Dict[str, Any]]] = data if data is None or isinstance(data, dict) else dict(data)
+
+    def read(self) -> Optional[Mapping[str, Dict[str, Any]]]:
         """
-        :return: The data from the cache.
+        :return: A read-only view of the data in the cache, which reflects later changes. Use `write` or `__setitem__`
+            to modify the data.
         """
-        return self._data
+        return MappingProxyType(self._data) if self._data is not None else None
 
-    def write(self, data: Dict[str, Dict[str, Any]]) -> None:
+    def write(self, data: Mapping[str, Dict[str, Any]]) -> None:
         """
         :param data: The data to write.
         """
         self._storage.write(data)
-        self._data = data
+        self._data = dict(data)
 
     def __getitem__(self, key: str) -> Optional[Dict[str, Any]]:
-        return self._data[key] if self._data else None
+        try:
+            # Indexing `None` raises `TypeError`, cheaper than checking for it every time.
+            return self._data[key]  # type: ignore[index]
+        except (TypeError, KeyError):
+            # Missing keys are only an error if there is any data.
+            if self._data:
+                raise
+            return None
 
     def __setitem__(self, key: str, value: Dict[str, Any]):
         """
-        If writing the new data to the underlying storage fails, the changes are reverted.
+        The item is written through the underlying storage, the cache is only updated if writing succeeds.
 
         :param key: Key of the item.
         :param value: Value of the item.
         :raises Exception: If any exception is raised when writing.
         """
-        # Save old value
-        old_none = object()
-        old_value = self._data.get(key, old_none)
+        key = sys.intern(key) if type(key) is str else key
+        self._storage[key] = value
+        if self._data is None:
+            self._data = dict()
+        self._data[key] = value
 
-        try:
-            # Try to write
-            self._data[key] = value
-            self._storage.write(self._data)
-        except Exception as e:
-            # Restore old value
-            if old_value is old_none:
-                self._data.pop(key, None)
-            else:
-                self._data[key] = old_value
-            raise e
+
+class StructStorage(Storage):
+    """
+    Storage for items that all share the same fields, kept as rows of a NumPy structured array memory-mapped from a
+    `.npy` file. Items take up a fixed amount of space each instead of one dictionary each. Requires `numpy`.
+    """
+
+    __slots__ = ('_path', '_fields', '_dtype', '_widths', '_array', '_index')
+
+    # Name of the field holding the keys. Rows with an empty key are free.
+    KEY_FIELD = '_key'
+
+    def __init__(self, path: str, schema: Dict[str, Any], key_size: int = 32, capacity: int = 64):
+        """
+        :param path: The path to the file. Created if it does not exist.
+        :param schema: The type of each field of the items, anything accepted by `numpy.dtype`.
+        :param key_size: Maximum length of the keys.
+        :param capacity: Number of items the file has room for when created. The file grows as needed.
+        :raises ImportError: If `numpy` is not installed.
+        :raises ValueError: If the file exists and does not match the schema.
+        """
+        if numpy is None:
+            raise ImportError(f"{self.__class__.__name__} requires numpy.")
+
+        self._path = path
+        self._fields = tuple(schema)
+        self._dtype = numpy.dtype([(self.KEY_FIELD, f'U{key_size}'), *schema.items()])
+
+        # Type and maximum length of each field, `None` for fields that are not strings.
+        self._widths = tuple(
+            (field, {'U': (str, kind.itemsize // 4), 'S': (bytes, kind.itemsize)}.get(kind.kind))
+            for field, kind in ((field, self._dtype[field]) for field in (self.KEY_FIELD, *self._fields))
+        )
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._array = numpy.lib.format.open_memmap(path, mode='r+')
+            if self._array.dtype != self._dtype:
+                raise ValueError(f"\'{path}\' does not match the schema.")
+        else:
+            self._array = numpy.lib.format.open_memmap(path, mode='w+', dtype=self._dtype, shape=(max(capacity, 1),))
+
+        # Row of each item, rows are used in order.
+        keys = self._array[self.KEY_FIELD].tolist()
+        self._index = {key: i for i, key in enumerate(keys) if key}
+
+    def close(self) -> None:
+        self._array.flush()
+        self._array = None  # type: ignore[assignment]
+
+    def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        if not self._index:
+            return None
+
+        rows = self._array[:len(self._index)].tolist()
+        return {row[0]: dict(zip(self._fields, row[1:])) for row in rows}
+
+    def write(self, data: Mapping[str, Dict[str, Any]]) -> None:
+        rows = [self._row(key, value) for key, value in data.items()]
+
+        self._reserve(len(rows))
+        self._array[:] = numpy.zeros(len(self._array), dtype=self._dtype)
+        for i, row in enumerate(rows):
+            self._array[i] = row
+        self._array.flush()
+
+        self._index = {row[0]: i for i, row in enumerate(rows)}
+
+    def __getitem__(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self._index:
+            return None
+
+        row = self._array[self._index[key]].item()
+        return dict(zip(self._fields, row[1:]))
+
+    def __setitem__(self, key: str, value: Dict[str, Any]):
+        row = self._row(key, value)
+
+        i = self._index.get(key)
+        if i is None:
+            i = len(self._index)
+            self._reserve(i + 1)
+
+        self._array[i] = row
+        self._array.flush()
+        self._index[key] = i
+
+    def _row(self, key: str, value: Dict[str, Any]) -> Tuple:
+        """
+        :param key: Key of the item.
+        :param value: The item.
+        :return: The row for the item.
+        :raises ValueError: If the key is empty or ends with a null character, or if the key or any string field is of
+            the wrong type or too long.
+        :raises KeyError: If the item lacks a field.
+        """
+        if not key:
+            raise ValueError(f"Invalid key \'{key}\'.")
+
+        row = (key, *(value[field] for field in self._fields))
+        for (field, limit), item in zip(self._widths, row):
+            if limit is None:
+                continue
+            kind, width = limit
+            if not isinstance(item, kind):
+                raise ValueError(f"Value of \'{field}\' is not {kind.__name__}.")
+            if len(item) > width:
+                raise ValueError(f"Value of \'{field}\' is longer than {width}.")
+
+        # NumPy drops trailing null characters, the key would be the same as a shorter one.
+        if key.endswith('\x00'):
+            raise ValueError(f"Invalid key {key!r}.")
+        return row
+
+    def _reserve(self, size: int) -> None:
+        """
+        Grow the file if it does not have room for the given number of items.
+
+        :param size: The number of items.
+        """
+        if size <= len(self._array):
+            return
+
+        # Copy the rows to a file with twice the rows, which then replaces the old one.
+        temp = self._path + '.tmp'
+        array = numpy.lib.format.open_memmap(
+            temp, mode='w+', dtype=self._dtype, shape=(max(size, 2 * len(self._array)),)
+        )
+        array[:len(self._array)] = self._array
+        array.flush()
+        os.replace(temp, self._path)
+        self._array = array
@@ -2,22 +2,27 @@ import time
 from typing import Callable, Optional, Any
 
 
-def timer(log: Callable[[str], Optional[Any]] = print):
+def timer(log: Optional[Callable[[str], Optional[Any]]] = print):
     """
     Print execution time to `log` function.
 
-    :param log: The function to log the result to.
+    :param log: The function to log the result to. If `None` the function is not timed.
     """
 
     def timer_decorator(func):
+        if log is None:
+            return func
+
+        name = func.__qualname__
+
         def timed(*args, **kwargs):
             # Run the function and time it.
-            start_time = time.time()
+            start_time = time.perf_counter_ns()
             result = func(*args, **kwargs)
-            end_time = time.time()
+            elapsed = time.perf_counter_ns() - start_time
 
             # Print to log function.
-            log(f"Function {func} took {end_time - start_time} seconds to run.")
+            log(f"Function {name} took {elapsed / 1e9} seconds to run.")
 
             return result
 
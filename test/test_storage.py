@@ -1,11 +1,15 @@
 import json
 import os
+import sys
 import tempfile
+import threading
 import unittest
 from contextlib import contextmanager
+from unittest import mock
 from typing import Optional
 
-from naivedb.storage import Storage, JSONStorage, MemoryStorage, ItemStorage
+from naivedb import storage as storage_module
+from naivedb.storage import Storage, JSONStorage, MemoryStorage, ItemStorage, StructStorage
 
 __version__ = '1.0'
 __author__ = 'Riccardo De Zen'
@@ -61,6 +65,85 @@ class JSONStorageTest(unittest.TestCase):
             with open(file) as f:
                 self.assertEqual(json.load(f), EXAMPLE_JSON)
 
+    def test_write_shorter(self):
+        for kwargs in ({}, {'indent': 2}, {'indent': 4}):
+            with temp_file() as file:
+                storage = JSONStorage(file, **kwargs)
+                storage.write({'key': {'another_key': 'a much longer value'}})
+                storage.write(EXAMPLE_JSON)
+                storage.close()
+                # File must be truncated to the new content.
+                with open(file) as f:
+                    self.assertEqual(json.load(f), EXAMPLE_JSON)
+
+    def test_write_append(self):
+        for mode in ('a', 'a+'):
+            with temp_file(json.dumps({'k': {}})) as file:
+                storage = JSONStorage(file, mode)
+                storage.write({'key': {'another_key': 'a much longer value'}})
+                storage.write(EXAMPLE_JSON)
+                storage.close()
+                # File must hold the last data, even if writes go at the end.
+                with open(file) as f:
+                    self.assertEqual(json.load(f), EXAMPLE_JSON)
+
+    def test_write_partial(self):
+        pwrite = os.pwrite
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file)
+            # Writes must go on until all the data is written.
+            with mock.patch.object(os, 'pwrite', lambda fd, data, offset: pwrite(fd, data[:3], offset)):
+                storage['key'] = {'a': 1}
+                storage['new_key'] = {'b': 2}
+                with open(file) as f:
+                    self.assertEqual(json.load(f), {'key': {'a': 1}, 'new_key': {'b': 2}})
+                storage.write({**EXAMPLE_JSON, 'other_key': {}})
+            storage.close()
+            with open(file) as f:
+                self.assertEqual(json.load(f), {**EXAMPLE_JSON, 'other_key': {}})
+
+    def test_write_fails(self):
+        for read in (True, False):
+            with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+                storage = JSONStorage(file, indent=4)
+                if read:
+                    storage.read()
+                self.assertRaises(TypeError, storage.write, {'key': {'a': 'value', 'b': object()}})
+                storage.close()
+                # Previous data must be left in the file.
+                with open(file) as f:
+                    self.assertEqual(json.load(f), EXAMPLE_JSON)
+
+    def test_write_cache_fails(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, indent=4)
+            data = storage.read()
+            data['key'] = {'b': object()}
+            self.assertRaises(TypeError, storage.write, data)
+            storage.close()
+            # Previous data must be left in the file.
+            with open(file) as f:
+                self.assertEqual(json.load(f), EXAMPLE_JSON)
+
+    def test_read_binary(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, mode='rb')
+            self.assertEqual(storage.read(), EXAMPLE_JSON)
+            storage.close()
+
+    @unittest.skipIf(storage_module.orjson is None, "orjson is not installed.")
+    def test_orjson(self):
+        data = {'key': {'big': 2 ** 70, 'inf': float('inf')}}
+        with temp_file(json.dumps(data)) as file:
+            storage = JSONStorage(file, use_orjson=True)
+            # Data `orjson` cannot handle must go through `json`.
+            self.assertEqual(storage.read(), data)
+            storage.write(dict(EXAMPLE_JSON))
+            storage['big'] = {'big': 2 ** 70}
+            storage.close()
+            with open(file) as f:
+                self.assertEqual(json.load(f), {**EXAMPLE_JSON, 'big': {'big': 2 ** 70}})
+
     def test_cannot_write(self):
         for mode in ('r', 'r+', 'w', 'w+', 'a', 'a+'):
             with temp_file() as file:
@@ -76,6 +159,17 @@ class JSONStorageTest(unittest.TestCase):
                     with open(file) as f:
                         self.assertEqual(json.load(f), EXAMPLE_JSON)
 
+    def test_close(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, wal=True)
+            storage['key'] = {}
+            # Files must be closed even if closing fails, and closing again must do nothing.
+            with mock.patch.object(os, 'fsync', side_effect=OSError("Sync failed.")):
+                self.assertRaises(OSError, storage.close)
+            self.assertTrue(storage._file.closed)
+            self.assertTrue(storage._wal.closed)
+            storage.close()
+
     def test_get_item(self):
         with temp_file() as file:
             storage = JSONStorage(file)
@@ -91,6 +185,224 @@ class JSONStorageTest(unittest.TestCase):
             self.assertEqual(storage['key'], new_item)
             storage.close()
 
+    def test_set_item_empty(self):
+        new_item = {'sub_key': 'sub_value'}
+        with temp_file() as file:
+            under = JSONStorage(file)
+            storage = ItemStorage(under)
+            # Nothing to read yet, the item must still be written.
+            storage['key'] = new_item
+            self.assertEqual(storage['key'], new_item)
+            under.close()
+            with open(file) as f:
+                self.assertEqual(json.load(f), {'key': new_item})
+
+    def test_set_item_in_place(self):
+        with temp_file(json.dumps({'a': {'x': 'long value'}, 'b': {'y': 1}})) as file:
+            size = os.path.getsize(file)
+            storage = JSONStorage(file)
+            # Items must be located correctly after reading the data.
+            storage.read()
+            storage['a'] = {'x': 'short'}
+            storage.close()
+            # Smaller value must fit in the old one's space.
+            self.assertEqual(os.path.getsize(file), size)
+            with open(file) as f:
+                self.assertEqual(json.load(f), {'a': {'x': 'short'}, 'b': {'y': 1}})
+
+    def test_set_item_append(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file)
+            for i in range(10):
+                storage['key'] = {'another_key': 'value' * i}
+                storage[f'key{i}'] = {'i': i}
+            storage.close()
+            # Bigger values and new keys must be readable back.
+            with open(file) as f:
+                data = json.load(f)
+            self.assertEqual(data['key'], {'another_key': 'value' * 9})
+            self.assertEqual(data['key9'], {'i': 9})
+            self.assertEqual(len(data), 11)
+
+    def test_set_item_sorted(self):
+        with temp_file(json.dumps({'b': {}, 'c': {}}, sort_keys=True)) as file:
+            storage = JSONStorage(file, sort_keys=True)
+            storage['a'] = {}
+            storage.close()
+            # Keys must stay sorted in the file.
+            with open(file) as f:
+                self.assertEqual(list(json.load(f)), ['a', 'b', 'c'])
+
+    def test_group_commit(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, group_commit_ms=1000)
+            with mock.patch.object(storage_module, '_datasync') as datasync:
+                for i in range(10):
+                    storage[f'key{i}'] = {'i': i}
+                # Writes must share a single sync.
+                datasync.assert_not_called()
+                storage.commit()
+                datasync.assert_called_once()
+            storage['key'] = {}
+            storage.close()
+            # Writes must reach the file even if the sync is deferred.
+            with open(file) as f:
+                data = json.load(f)
+            self.assertEqual(data['key9'], {'i': 9})
+            self.assertEqual(data['key'], {})
+
+    def test_group_commit_fails(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, group_commit_ms=100)
+            with mock.patch.object(storage_module, '_datasync', side_effect=OSError("Sync failed.")):
+                storage['key'] = {}
+                storage._timer.join()
+            # Error of the timer must be raised by the next commit, only once.
+            self.assertRaises(OSError, storage.commit)
+            storage.commit()
+            storage.close()
+
+    def test_wal(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, wal=True)
+            storage['key'] = {'sub_key': 'sub_value'}
+            storage['new_key'] = {}
+            # Items must only be in the log, and be replayed on top of the file.
+            with open(file) as f:
+                self.assertEqual(json.load(f), EXAMPLE_JSON)
+            replayed = JSONStorage(file, mode='r', wal=True)
+            self.assertEqual(replayed.read(), {'key': {'sub_key': 'sub_value'}, 'new_key': {}})
+            replayed.close()
+            storage.close()
+            # Log must be merged into the file when closing.
+            self.assertEqual(os.path.getsize(file + '.wal'), 0)
+            with open(file) as f:
+                self.assertEqual(json.load(f), {'key': {'sub_key': 'sub_value'}, 'new_key': {}})
+
+    @unittest.skipIf(storage_module.fcntl is None, "fcntl is not available.")
+    def test_wal_merge_locked(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, wal=True)
+            storage['key'] = {'v': 1}
+            fcntl = storage_module.fcntl
+            locked = []
+
+            def fsync(this, f):
+                # Readers must not get in while the file and the log disagree.
+                with open(file) as reader:
+                    try:
+                        fcntl.flock(reader.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                        locked.append(False)
+                    except BlockingIOError:
+                        locked.append(True)
+
+            with mock.patch.object(JSONStorage, '_fsync', fsync):
+                storage.write({'key': {'v': 2}})
+            self.assertEqual(locked, [True, True])
+            storage.close()
+            replayed = JSONStorage(file, mode='r', wal=True)
+            self.assertEqual(replayed.read(), {'key': {'v': 2}})
+            replayed.close()
+
+    def test_interned_keys(self):
+        with temp_file(json.dumps({'some_key': {}})) as file:
+            storage = JSONStorage(file)
+            key = next(iter(storage.read()))
+            storage.close()
+            # Keys must be shared with equal keys built elsewhere.
+            self.assertIs(key, sys.intern(''.join(['some', '_key'])))
+
+    @unittest.skipIf(storage_module.fcntl is None, "fcntl is not available.")
+    def test_lock_released(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file)
+            storage.read()
+            storage['key'] = {}
+            storage.write(EXAMPLE_JSON)
+            # No lock must be held between operations.
+            with open(file) as f:
+                storage_module.fcntl.flock(f, storage_module.fcntl.LOCK_EX | storage_module.fcntl.LOCK_NB)
+            storage.close()
+
+    @unittest.skipIf(storage_module.fcntl is None, "fcntl is not available.")
+    def test_lock_taken(self):
+        fcntl = storage_module.fcntl
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file)
+            for operation, lock in ((storage.read, fcntl.LOCK_EX), (lambda: storage.write({}), fcntl.LOCK_SH)):
+                with open(file) as f:
+                    fcntl.flock(f, lock)
+                    thread = threading.Thread(target=operation)
+                    thread.start()
+                    # Operation must wait for the lock held by another process.
+                    thread.join(0.1)
+                    self.assertTrue(thread.is_alive())
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    thread.join()
+            self.assertEqual(storage.read(), {})
+            storage.close()
+
+    def test_write_copies(self):
+        with temp_file() as file:
+            storage = JSONStorage(file)
+            data = dict(EXAMPLE_JSON)
+            storage.write(data)
+            data['leak'] = {}
+            # Changes to the written dictionary must not reach the storage.
+            self.assertNotIn('leak', storage.read())
+            storage.close()
+
+    def test_wal_torn(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            with open(file + '.wal', 'w') as f:
+                f.write('{"k": "x", "v": {"t"')
+            storage = JSONStorage(file, wal=True)
+            storage['new_key'] = {}
+            # Records after an incomplete one must not be lost.
+            self.assertEqual(storage.reload(), {**EXAMPLE_JSON, 'new_key': {}})
+            storage.close()
+            with open(file) as f:
+                self.assertEqual(json.load(f), {**EXAMPLE_JSON, 'new_key': {}})
+
+    def test_wal_stale(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, wal=True)
+            storage['key'] = {'v': 1}
+            with open(file + '.wal', 'rb') as f:
+                log = f.read()
+            storage.write({'key': {'v': 2}})
+            storage.close()
+            # Crash after merging the log, before emptying it.
+            with open(file + '.wal', 'wb') as f:
+                f.write(log)
+            replayed = JSONStorage(file, mode='r', wal=True)
+            self.assertEqual(replayed.read(), {'key': {'v': 2}})
+            replayed.close()
+            # Stale log must be dropped, so that new records are not ignored with it.
+            storage = JSONStorage(file, wal=True)
+            storage['new_key'] = {}
+            self.assertEqual(storage.reload(), {'key': {'v': 2}, 'new_key': {}})
+            storage.close()
+
+    def test_wal_read_only(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file, mode='r', wal=True)
+            self.assertEqual(storage.read(), EXAMPLE_JSON)
+            storage.close()
+            # Read only storage must not create a log.
+            self.assertFalse(os.path.exists(file + '.wal'))
+
+    def test_reload(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            storage = JSONStorage(file)
+            self.assertEqual(storage.read(), EXAMPLE_JSON)
+            with open(file, 'w') as f:
+                json.dump({}, f)
+            # Storage is not supposed to notice until reloaded.
+            self.assertEqual(storage.read(), EXAMPLE_JSON)
+            self.assertEqual(storage.reload(), {})
+            storage.close()
+
 
 class MemoryStorageTest(unittest.TestCase):
 
@@ -104,6 +416,15 @@ class MemoryStorageTest(unittest.TestCase):
         m = MemoryStorage()
         self.assertIsNone(m.read())
 
+    def test_get_item_missing(self):
+        m = MemoryStorage()
+        self.assertRaises(KeyError, m.__getitem__, 'key')
+
+    def test_set_item_empty(self):
+        m = MemoryStorage()
+        m['key'] = {}
+        self.assertEqual(m.read(), {'key': {}})
+
 
 class ItemStorageTest(unittest.TestCase):
 
@@ -120,15 +441,132 @@ class ItemStorageTest(unittest.TestCase):
         self.storage.write(EXAMPLE_JSON)
         self.assertEqual(self.under.read(), EXAMPLE_JSON)
 
+    def test_read_only(self):
+        self.storage.write(dict(EXAMPLE_JSON))
+        data = self.storage.read()
+        with self.assertRaises(TypeError):
+            data['key'] = {}
+        # View must reflect changes made through the storage.
+        self.storage['new_key'] = {}
+        self.assertEqual(data['new_key'], {})
+
     def test_get_item(self):
         self.storage.write(EXAMPLE_JSON)
         self.assertEqual(self.storage['key'], EXAMPLE_JSON['key'])
 
+    def test_wrap(self):
+        self.storage.write(dict(EXAMPLE_JSON))
+        storage = ItemStorage(self.storage)
+        storage['new_key'] = {}
+        # Items must go through both storages.
+        self.assertEqual(self.under['new_key'], {})
+        self.assertEqual(storage['new_key'], {})
+
     def test_set_item(self):
         new_item = {'sub_key': 'sub_value'}
         self.storage.write(EXAMPLE_JSON)
         self.storage['key'] = new_item
         self.assertEqual(self.storage['key'], new_item)
 
+    def test_set_item_fails(self):
+        with temp_file(json.dumps(EXAMPLE_JSON)) as file:
+            under = JSONStorage(file, mode='r')
+            storage = ItemStorage(under)
+            self.assertRaises(IOError, storage.__setitem__, 'key', {'sub_key': 'sub_value'})
+            # Cache must not change if writing fails.
+            self.assertEqual(storage['key'], EXAMPLE_JSON['key'])
+            under.close()
+
+    def test_copy(self):
+        self.storage.write(dict(EXAMPLE_JSON))
+        # Read-only data must be accepted by other storages.
+        with temp_file() as file:
+            storage = JSONStorage(file)
+            storage.write(self.storage.read())
+            storage.close()
+            with open(file) as f:
+                self.assertEqual(json.load(f), EXAMPLE_JSON)
+        memory = MemoryStorage()
+        memory.write(self.storage.read())
+        memory['new_key'] = {}
+        self.assertEqual(memory.read(), {**EXAMPLE_JSON, 'new_key': {}})
+        storage = ItemStorage(MemoryStorage())
+        storage.write(self.storage.read())
+        storage['new_key'] = {}
+        self.assertEqual(storage.read(), {**EXAMPLE_JSON, 'new_key': {}})
+
+    def test_get_item_missing(self):
+        # No data, no item.
+        self.assertIsNone(self.storage['key'])
+        self.storage.write({'another_key': {}})
+        self.assertRaises(KeyError, self.storage.__getitem__, 'key')
+
     def test_begins_none(self):
         self.assertIsNone(self.storage.read())
+
+    def test_set_item_empty(self):
+        self.storage['key'] = {}
+        # Items must go through both storages.
+        self.assertEqual(self.under.read(), {'key': {}})
+        self.assertEqual(self.storage.read(), {'key': {}})
+
+
+@unittest.skipIf(storage_module.numpy is None, "numpy is not installed.")
+class StructStorageTest(unittest.TestCase):
+    SCHEMA = {'name': 'U16', 'age': 'i4'}
+
+    def test_begins_none(self):
+        with temp_file() as file:
+            storage = StructStorage(file, self.SCHEMA)
+            self.assertIsNone(storage.read())
+            storage.close()
+
+    def test_read_and_write(self):
+        data = {'a': {'name': 'Alice', 'age': 30}, 'b': {'name': 'Bob', 'age': 40}}
+        with temp_file() as file:
+            storage = StructStorage(file, self.SCHEMA)
+            storage.write(data)
+            storage.close()
+            # Data must survive reopening the file.
+            storage = StructStorage(file, self.SCHEMA)
+            self.assertEqual(storage.read(), data)
+            storage.close()
+
+    def test_set_item(self):
+        with temp_file() as file:
+            storage = StructStorage(file, self.SCHEMA, capacity=1)
+            for i in range(10):
+                storage[f'key{i}'] = {'name': f'name{i}', 'age': i}
+            storage['key0'] = {'name': 'changed', 'age': -1}
+            # File must grow to fit new items.
+            self.assertEqual(storage['key9'], {'name': 'name9', 'age': 9})
+            self.assertEqual(storage['key0'], {'name': 'changed', 'age': -1})
+            self.assertEqual(len(storage.read()), 10)
+            storage.close()
+
+    def test_too_long(self):
+        with temp_file() as file:
+            storage = StructStorage(file, {'name': 'U8', 'code': 'S2'}, key_size=4)
+            self.assertRaises(ValueError, storage.__setitem__, 'key', {'name': 'way too long name', 'code': b'a'})
+            self.assertRaises(ValueError, storage.__setitem__, 'key', {'name': 'name', 'code': b'abc'})
+            self.assertRaises(ValueError, storage.__setitem__, 'long key', {'name': 'name', 'code': b'a'})
+            # Nothing must be stored.
+            self.assertIsNone(storage.read())
+            storage.close()
+
+    def test_invalid(self):
+        with temp_file() as file:
+            storage = StructStorage(file, {'name': 'U8', 'code': 'S2'})
+            storage['x'] = {'name': 'name', 'code': b'a'}
+            # Key must not collide with a shorter one.
+            self.assertRaises(ValueError, storage.__setitem__, 'x\x00', {'name': 'name', 'code': b'b'})
+            # Strings must be of the type of their field.
+            self.assertRaises(ValueError, storage.__setitem__, 'y', {'name': 1, 'code': b'a'})
+            self.assertRaises(ValueError, storage.__setitem__, 'y', {'name': 'name', 'code': 'a'})
+            self.assertEqual(storage.read(), {'x': {'name': 'name', 'code': b'a'}})
+            storage.close()
+
+    def test_wrong_schema(self):
+        with temp_file() as file:
+            StructStorage(file, self.SCHEMA).close()
+            self.assertRaises(ValueError, StructStorage, file, {'name': 'U16'})